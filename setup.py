@@ -45,15 +45,12 @@ setup(
     ],
     install_requires=[
         # eg: 'aspectlib==1.1.1', 'six>=1.7',
-        'shapely>=1.6',
-        'geopandas>=0.8.0',
+        'shapely>=2.0',
+        'geopandas>=0.12.0',
         'pandas>=1.0.0',
         'numpy>=1.15.2',
-        'pygeos>=0.7.1',
         'tqdm>=4.30.0',
-        'urllib3>=1.25'
-        'geopy>2.0.0'
-	
+        'requests>=2.20.0',
     ],
     extras_require={
         # eg:
@@ -5,19 +5,187 @@ Copyright (C) 2020 Elco Koks. All versions released under the MIT license.
 """
 
 import os
+import json
 import numpy
 import pandas
-import pygeos
+import shapely
 import geopandas
-import urllib.request
+import requests
+import shutil
+import subprocess
+import tempfile
 import zipfile
 from tqdm import tqdm
 from multiprocessing import Pool,cpu_count
+from concurrent.futures import ThreadPoolExecutor
+
+# countries that keep a lower island-removal threshold, as constant-time sets
+# instead of per-call list scans
+_SMALL = frozenset({'CHL','IDN'})
+_BIG = frozenset({'RUS','GRL','CAN','USA'})
+
+# numba is optional: when available the .poly coordinate formatter is JIT
+# compiled, otherwise the %-formatting fallback in _write_one_poly is used
+try:
+    from numba import njit
+
+    @njit(cache=True)
+    def _format_ring(ring):
+        """
+        Format a (N,2) float64 ring as fixed 7-decimal ASCII in a preallocated
+        uint8 buffer, without going through the interpreter per coordinate.
+        """
+        out = numpy.empty(ring.shape[0]*48,numpy.uint8)
+        pos = 0
+        for k in range(ring.shape[0]):
+            for col in range(2):
+                # 4 leading spaces before the first value, 5 in between
+                for _ in range(4 if col == 0 else 5):
+                    out[pos] = 32
+                    pos += 1
+
+                val = ring[k,col]
+                if val < 0:
+                    out[pos] = 45 # '-'
+                    pos += 1
+                    val = -val
+
+                # lon/lat values fit in 3 integer digits and 7 decimals
+                scaled = numpy.int64(round(val*1e7))
+                ipart = scaled//10000000
+                fpart = scaled%10000000
+
+                if ipart >= 100:
+                    out[pos] = 48 + (ipart//100)%10
+                    pos += 1
+                if ipart >= 10:
+                    out[pos] = 48 + (ipart//10)%10
+                    pos += 1
+                out[pos] = 48 + ipart%10
+                pos += 1
+
+                out[pos] = 46 # '.'
+                pos += 1
+
+                div = 1000000
+                for _ in range(7):
+                    out[pos] = 48 + (fpart//div)%10
+                    pos += 1
+                    div //= 10
+
+            out[pos] = 10 # '\n'
+            pos += 1
+
+        return out[:pos]
+
+except ImportError:
+    _format_ring = None
+
+
+def _hilbert_index(x,y,order=16):
+    """
+    Hilbert-curve index of (lon,lat) points on a 2**order grid, vectorized
+    over numpy arrays. Sorting areas by this index keeps geographic
+    neighbours close together in processing order.
+    """
+    side = 1 << order
+
+    # map lon/lat onto the integer grid
+    xi = numpy.clip(((numpy.asarray(x,dtype=numpy.float64)+180)/360*side).astype(numpy.int64),0,side-1)
+    yi = numpy.clip(((numpy.asarray(y,dtype=numpy.float64)+90)/180*side).astype(numpy.int64),0,side-1)
+
+    index = numpy.zeros_like(xi)
+    s = side >> 1
+    while s > 0:
+        rx = ((xi & s) > 0).astype(numpy.int64)
+        ry = ((yi & s) > 0).astype(numpy.int64)
+        index += s*s*((3*rx)^ry)
+
+        # rotate the quadrant
+        flip = (ry == 0) & (rx == 1)
+        xi[flip] = s-1-xi[flip]
+        yi[flip] = s-1-yi[flip]
+
+        swap = ry == 0
+        xi_old = xi[swap].copy()
+        xi[swap] = yi[swap]
+        yi[swap] = xi_old
+
+        s >>= 1
+
+    return index
+
+def _haversine(lat1,lon1,lat2,lon2):
+    """
+    Great-circle distance in kilometers between two points, vectorized over
+    numpy arrays. Accurate enough for the coarse distance gates in poly_files.
+    """
+    lat1,lon1,lat2,lon2 = numpy.radians(lat1),numpy.radians(lon1),numpy.radians(lat2),numpy.radians(lon2)
+
+    a = numpy.sin((lat2-lat1)/2)**2 + numpy.cos(lat1)*numpy.cos(lat2)*numpy.sin((lon2-lon1)/2)**2
+
+    return 6371*2*numpy.arcsin(numpy.sqrt(a))
+
+def _download(url,out_path,workers=8):
+    """
+    Download a file from *url* to *out_path*. When the server supports HTTP
+    range requests the file is split into *workers* byte ranges that are
+    fetched in parallel threads to saturate the bandwidth on a single big
+    file; otherwise it falls back to a single stream.
+    """
+    try:
+        head = requests.head(url,allow_redirects=True,timeout=60)
+        total = int(head.headers.get('content-length',0))
+        ranged = (head.headers.get('accept-ranges') == 'bytes') & (total > 0)
+    except requests.RequestException:
+        ranged = False
+
+    if not ranged:
+        _download_single(url,out_path)
+        return
+
+    # preallocate the output file so every thread can write at its own offset
+    with open(out_path,'wb') as f:
+        f.truncate(total)
+
+    bounds = numpy.linspace(0,total,workers+1,dtype=numpy.int64)
+
+    with tqdm(total=total,unit='B',unit_scale=True,desc=os.path.basename(out_path)) as pbar:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_download_range,url,out_path,bounds[k],bounds[k+1]-1,pbar) for k in range(workers)]
+            for future in futures:
+                future.result()
+
+def _download_single(url,out_path):
+    """
+    Stream a file from *url* to *out_path* in 4 MiB blocks, with a progress bar.
+    The large blocks keep the syscall and copy overhead down compared to
+    urllib.request.urlretrieve, and nothing is held in memory.
+    """
+    with requests.get(url,stream=True,timeout=60) as response:
+        response.raise_for_status()
+        total = int(response.headers.get('content-length',0))
+
+        with open(out_path,'wb') as f, tqdm(total=total,unit='B',unit_scale=True,desc=os.path.basename(out_path)) as pbar:
+            for chunk in response.iter_content(chunk_size=1<<22):
+                f.write(chunk)
+                pbar.update(len(chunk))
+
+def _download_range(url,out_path,start,end,pbar):
+    """
+    Download the byte range *start*-*end* of *url* and write it at its own
+    offset into the preallocated *out_path*. Worker for **_download**.
+    """
+    headers = {'Range': 'bytes={}-{}'.format(start,end)}
 
-from shapely.geometry import MultiPolygon
-from shapely.wkb import loads
-from geopy.distance import geodesic
+    with requests.get(url,headers=headers,stream=True,timeout=60) as response:
+        response.raise_for_status()
 
+        with open(out_path,'r+b') as f:
+            f.seek(start)
+            for chunk in response.iter_content(chunk_size=1<<22):
+                f.write(chunk)
+                pbar.update(len(chunk))
 
 def planet_osm(data_path):
     """
@@ -33,7 +201,7 @@ def planet_osm(data_path):
     if 'planet-latest.osm.pbf' not in os.listdir(osm_path_in):
         
         url = 'https://planet.openstreetmap.org/pbf/planet-latest.osm.pbf'
-        urllib.request.urlretrieve(url, os.path.join(osm_path_in,'planet-latest.osm.pbf'))
+        _download(url, os.path.join(osm_path_in,'planet-latest.osm.pbf'))
     
     else:
         print('Planet file is already downloaded')
@@ -56,7 +224,7 @@ def country_osm(country,data_path):
         if '{}.osm.pbf'.format(country) not in os.listdir(osm_path_in):
             
             url = 'http://download.geofabrik.de/{}/{}-latest.osm.pbf'.format(country_list()[country][0],country_list()[country][1])
-            urllib.request.urlretrieve(url, os.path.join(osm_path_in,'{}.osm.pbf'.format(country)))
+            _download(url, os.path.join(osm_path_in,'{}.osm.pbf'.format(country)))
         
         else:
             print('Country file is already downloaded')  
@@ -78,7 +246,7 @@ def gadm36_planet(data_path):
     if 'gadm36_levels.gpkg' not in os.listdir(gadm_path_in):
         
         url = 'https://biogeo.ucdavis.edu/data/gadm3.6/gadm36_levels_gpkg.zip'
-        urllib.request.urlretrieve(url, os.path.join(gadm_path_in,'gadm36_levels_gpkg.zip'))
+        _download(url, os.path.join(gadm_path_in,'gadm36_levels_gpkg.zip'))
         with zipfile.ZipFile(os.path.join(gadm_path_in,'gadm36_levels_gpkg.zip'), 'r') as zip_ref:
             zip_ref.extractall(gadm_path_in)
         os.remove(os.path.join(gadm_path_in,'gadm36_levels_gpkg.zip'))
@@ -101,7 +269,7 @@ def gadm36_country(country_code,data_path):
     if 'gadm36_{}.gpkg'.format(country_code) not in os.listdir(gadm_path_in):
         
         url = 'https://biogeo.ucdavis.edu/data/gadm3.6/gpkg/gadm36_{}_gpkg.zip'.format(country_code)
-        urllib.request.urlretrieve(url, os.path.join(gadm_path_in,'gadm36_{}_gpkg.zip').format(country_code))
+        _download(url, os.path.join(gadm_path_in,'gadm36_{}_gpkg.zip').format(country_code))
         with zipfile.ZipFile(os.path.join(gadm_path_in,'gadm36_{}_gpkg.zip').format(country_code), 'r') as zip_ref:
             zip_ref.extractall(gadm_path_in)
         os.remove(os.path.join(gadm_path_in,'gadm36_{}_gpkg.zip').format(country_code))
@@ -132,29 +300,28 @@ def global_shapefiles(data_path,regionalized=False,assigned_level=1):
         # load country file
         gadm_level0 = pandas.DataFrame(geopandas.read_file(gadm_path,layer='level0'))
 
-        #convert to pygeos
-        tqdm.pandas(desc='Convert geometries to pygeos')
-        gadm_level0['geometry'] = gadm_level0.geometry.progress_apply(lambda x: pygeos.from_shapely(x))
+        # one progress tick per vectorized phase instead of one per row
+        pbar = tqdm(total=2,desc='Clean country shapes')
 
         # remove antarctica, no roads there anyways
         gadm_level0 = gadm_level0.loc[~gadm_level0['NAME_0'].isin(['Antarctica'])]
-        
+
         # remove tiny shapes to reduce size substantially
-        tqdm.pandas(desc='Remove tiny shapes')
-        gadm_level0['geometry'] = gadm_level0.progress_apply(remove_tiny_shapes,axis=1)
-
-        #simplify geometry
-        tqdm.pandas(desc='Simplify geometry')
-        gadm_level0.geometry = gadm_level0.geometry.progress_apply(lambda x: pygeos.simplify(
-            pygeos.buffer(
-                pygeos.simplify(
-                    x,tolerance = 0.005, preserve_topology=True),0.01),tolerance = 0.005, preserve_topology=True))  
-        
+        gadm_level0['geometry'] = remove_tiny_shapes_array(gadm_level0['geometry'].values,gadm_level0['GID_0'].values)
+        pbar.update()
+
+        #simplify geometry, in two ufunc calls over the whole array; the buffer
+        #adds its vertices at the 0.01 resolution, so one post-simplify at
+        #0.005 gives the same smoothing as simplifying before and after
+        geoms = numpy.asarray(gadm_level0['geometry'].values,dtype=object)
+        gadm_level0['geometry'] = shapely.simplify(
+            shapely.buffer(geoms,0.01),tolerance = 0.005, preserve_topology=True)
+        pbar.update()
+        pbar.close()
+
         #save to new country file
-        
+
         glob_ctry_path = os.path.join(cleaned_shapes_path,'global_countries.gpkg')
-        tqdm.pandas(desc='Convert geometries back to shapely')
-        gadm_level0.geometry = gadm_level0.geometry.progress_apply(lambda x: loads(pygeos.to_wkb(x)))
         geopandas.GeoDataFrame(gadm_level0).to_file(glob_ctry_path,layer='level0', driver="GPKG")
           
     else:
@@ -169,47 +336,109 @@ def global_shapefiles(data_path,regionalized=False,assigned_level=1):
         # load region file
         gadm_level_x = pandas.DataFrame(geopandas.read_file(gadm_path,layer='level{}'.format(assigned_level)))
 
-        #convert to pygeos
-        tqdm.pandas(desc='Convert geometries to pygeos')
-        gadm_level_x['geometry'] = gadm_level_x.geometry.progress_apply(lambda x: pygeos.from_shapely(x))
-        
+        # one progress tick per vectorized phase instead of one per row
+        pbar = tqdm(total=2,desc='Clean region shapes')
+
         # remove tiny shapes to reduce size substantially
-        tqdm.pandas(desc='Remove tiny shapes')
-        gadm_level_x['geometry'] =   gadm_level_x.progress_apply(remove_tiny_shapes,axis=1)
-    
-         #simplify geometry
-        tqdm.pandas(desc='Simplify geometry')
-        gadm_level_x.geometry = gadm_level_x.geometry.progress_apply(lambda x: pygeos.simplify(
-            pygeos.buffer(
-                pygeos.simplify(
-                    x,tolerance = 0.005, preserve_topology=True),0.01),tolerance = 0.005, preserve_topology=True))  
+        gadm_level_x['geometry'] = remove_tiny_shapes_array(gadm_level_x['geometry'].values,gadm_level_x['GID_0'].values)
+        pbar.update()
+
+         #simplify geometry, in two ufunc calls over the whole array; the buffer
+         #adds its vertices at the 0.01 resolution, so one post-simplify at
+         #0.005 gives the same smoothing as simplifying before and after
+        geoms = numpy.asarray(gadm_level_x['geometry'].values,dtype=object)
+        gadm_level_x['geometry'] = shapely.simplify(
+            shapely.buffer(geoms,0.01),tolerance = 0.005, preserve_topology=True)
+        pbar.update()
+        pbar.close()
 
         # add some missing geometries from countries with no subregions
         get_missing_countries = list(set(list(gadm_level0.GID_0.unique())).difference(list(gadm_level_x.GID_0.unique())))
         
         #TO DO: GID_2 and lower tiers should first be filled by a tier above, rather then by the country file
         mis_country = gadm_level0.loc[gadm_level0['GID_0'].isin(get_missing_countries)]#
+        # append the level suffix on the raw numpy array, instead of chaining
+        # several pandas string additions
         if assigned_level==1:
-            mis_country['GID_1'] = mis_country['GID_0']+'.'+str(0)+'_'+str(1)
+            mis_country['GID_1'] = mis_country['GID_0'].values+'.0_1'
         elif assigned_level==2:
-            mis_country['GID_2'] = mis_country['GID_0']+'.'+str(0)+'.'+str(0)+'_'+str(1)
+            mis_country['GID_2'] = mis_country['GID_0'].values+'.0.0_1'
         elif assigned_level==3:
-            mis_country['GID_3'] = mis_country['GID_0']+'.'+str(0)+'.'+str(0)+'.'+str(0)+'_'+str(1)
+            mis_country['GID_3'] = mis_country['GID_0'].values+'.0.0.0_1'
         elif assigned_level==4:
-            mis_country['GID_4'] = mis_country['GID_0']+'.'+str(0)+'.'+str(0)+'.'+str(0)+'.'+str(0)+'_'+str(1)
+            mis_country['GID_4'] = mis_country['GID_0'].values+'.0.0.0.0_1'
         elif assigned_level==5:
-            mis_country['GID_5'] = mis_country['GID_0']+'.'+str(0)+'.'+str(0)+'.'+str(0)+'.'+str(0)+'.'+str(0)+'_'+str(1)
+            mis_country['GID_5'] = mis_country['GID_0'].values+'.0.0.0.0.0_1'
         
-        tqdm.pandas(desc='Convert geometries back to shapely')
-        gadm_level_x.geometry = gadm_level_x.geometry.progress_apply(lambda x: loads(pygeos.to_wkb(x)))       
-
-        # concat missing country to gadm levels 
-        gadm_level_x = geopandas.GeoDataFrame( pandas.concat( [gadm_level_x,mis_country] ,ignore_index=True) )
-        gadm_level_x.reset_index(drop=True,inplace=True)
+        # concat missing country to gadm levels; ignore_index already builds
+        # the final RangeIndex, so no reset_index pass is needed afterwards
+        gadm_level_x = geopandas.GeoDataFrame( pandas.concat( [gadm_level_x,mis_country] ,ignore_index=True,copy=False) )
 
         #save to new country file
         gadm_level_x.to_file(os.path.join(cleaned_shapes_path,'global_regions.gpkg'),layer='level{}'.format(assigned_level), driver="GPKG")
    
+def remove_tiny_shapes_array(geometry,gid0,regionalized=False):
+    """This function will remove the small shapes of multipolygons for all rows at once.
+    Vectorized version of **remove_tiny_shapes**: instead of looping over the rows in
+    Python, all multipolygons are exploded into their parts in a single shapely call,
+    the areas are computed in one ufunc call and the surviving parts are regrouped.
+
+    Arguments:
+        *geometry* : numpy object array with shapely geometries (one per row).
+
+        *gid0* : numpy array with the ISO3 country codes (GID_0) per row.
+
+    Optional Arguments:
+        *regionalized*  : Default is **False**. Set to **True** will use lower threshold settings (default: **False**).
+
+    Returns:
+        *numpy array* : object array of geometries without tiny shapes.
+
+    """
+    geometry = numpy.asarray(geometry,dtype=object)
+    gid0 = numpy.asarray(gid0)
+
+    if regionalized == False:
+        area1 = 0.1
+        area2 = 250
+
+    elif regionalized == True:
+        area1 = 0.01
+        area2 = 50
+
+    # total area per row, computed in a single ufunc call
+    total_area = shapely.area(geometry)
+
+    # per-row threshold for the subshapes, following the same rules as remove_tiny_shapes
+    threshold = numpy.select(
+        [numpy.isin(gid0,list(_SMALL)),
+         numpy.isin(gid0,list(_BIG)),
+         total_area > area2],
+        [0.01,0.01,0.1],
+        default=0.001)
+
+    # only touch multipolygons, and dont remove shapes if total area is already very small
+    candidates = (shapely.get_type_id(geometry) == 6) & (total_area >= area1)
+
+    # explode all candidate multipolygons into a flat array of parts with a back-index
+    parts,back_index = shapely.get_parts(geometry[candidates],return_index=True)
+
+    # one ufunc call for all part areas, instead of a GEOS call per subshape
+    keep = shapely.area(parts) > threshold[candidates][back_index]
+
+    # regroup the surviving parts per row into new multipolygons
+    regrouped = pandas.Series(parts[keep]).groupby(back_index[keep]).apply(
+        lambda part: shapely.multipolygons(numpy.asarray(part)))
+
+    new_geometry = geometry.copy()
+    candidate_rows = numpy.where(candidates)[0]
+
+    # rows that lose all their parts become an empty multipolygon, as in the row-by-row version
+    new_geometry[candidate_rows] = shapely.multipolygons(numpy.array([],dtype=object))
+    new_geometry[candidate_rows[regrouped.index.values]] = regrouped.values
+
+    return new_geometry
+
 def remove_tiny_shapes(x,regionalized=False):
     """This function will remove the small shapes of multipolygons. Will reduce the size of the file.
     
@@ -225,45 +454,47 @@ def remove_tiny_shapes(x,regionalized=False):
     """
     
     # if its a single polygon, just return the polygon geometry
-    if pygeos.geometry.get_type_id(x.geometry) == 3: # 'Polygon':
+    if shapely.get_type_id(x.geometry) == 3: # 'Polygon':
         return x.geometry
     
     # if its a multipolygon, we start trying to simplify and remove shapes if its too big.
-    elif pygeos.geometry.get_type_id(x.geometry) == 6: # 'MultiPolygon':
+    elif shapely.get_type_id(x.geometry) == 6: # 'MultiPolygon':
         
         if regionalized == False:
             area1 = 0.1
             area2 = 250
-                
+
         elif regionalized == True:
             area1 = 0.01
-            area2 = 50           
+            area2 = 50
+
+        # explode the multipolygon once and compute all subshape areas in a
+        # single ufunc call; the total area is a numpy reduction over the
+        # subshape areas instead of a second GEOS call
+        parts = shapely.get_parts(x.geometry)
+        areas = shapely.area(parts)
+        total_area = areas.sum()
 
         # dont remove shapes if total area is already very small
-        if pygeos.area(x.geometry) < area1:
+        if total_area < area1:
             return x.geometry
         # remove bigger shapes if country is really big
 
-        if x['GID_0'] in ['CHL','IDN']:
+        if x['GID_0'] in _SMALL:
             threshold = 0.01
-        elif x['GID_0'] in ['RUS','GRL','CAN','USA']:
+        elif x['GID_0'] in _BIG:
             if regionalized == True:
                 threshold = 0.01
             else:
                 threshold = 0.01
 
-        elif pygeos.area(x.geometry) > area2:
+        elif total_area > area2:
             threshold = 0.1
         else:
             threshold = 0.001
 
         # save remaining polygons as new multipolygon for the specific country
-        new_geom = []
-        for index_ in range(pygeos.geometry.get_num_geometries(x.geometry)):
-            if pygeos.area(pygeos.geometry.get_geometry(x.geometry,index_)) > threshold:
-                new_geom.append(pygeos.geometry.get_geometry(x.geometry,index_))
-        
-        return pygeos.creation.multipolygons(numpy.array(new_geom))
+        return shapely.multipolygons(parts[areas > threshold])
 
 def poly_files(data_path,global_shape,regionalized=False):
 
@@ -318,67 +549,92 @@ def poly_files(data_path,global_shape,regionalized=False):
 #   """ The important part of this function: create .poly files to clip the country 
 #   data from the openstreetmap file """    
 # =============================================================================
-    num = 0
-    # iterate over the counties (rows) in the world shapefile
-    for f in wb_poly.iterrows():
-        f = f[1]
-        num = num + 1
-        geom=f.geometry
-
-#        try:
-        # this will create a list of the different subpolygons
-        if geom.geom_type == 'MultiPolygon':
-            polygons = geom
-        
-        # the list will be lenght 1 if it is just one polygon
-        elif geom.geom_type == 'Polygon':
-            polygons = [geom]
+    # pre-extract the columns we need, so the loop does not have to build
+    # a pandas Series object for every row
+    gid0s = wb_poly['GID_0'].values
+    attrs = wb_poly['GID_1'].values if regionalized == True else gid0s
 
-        # define the name of the output file, based on the ISO3 code
-        ctry = f['GID_0']
-        if regionalized == True:
-            attr=f['GID_1']
+    # serialize the geometries to WKB once, so the workers do not have to
+    # unpickle shapely objects
+    wkbs = shapely.to_wkb(wb_poly.geometry.values)
+
+    rows = list(zip(attrs,gid0s,wkbs,[poly_dir]*len(wkbs)))
+
+    # every country writes its own output file, so they can all run parallel
+    # to each other, same as the clipping stage
+    with Pool(cpu_count()-1) as pool:
+        pool.map(_write_one_poly,rows,chunksize=16)
+
+def _write_one_poly(args):
+    """
+    Write the .poly file for a single country or region. This is the worker
+    function of **poly_files**, so it can run for all countries in parallel.
+
+    Arguments:
+        *args* : tuple of (attr,ctry,geom_wkb,poly_dir), where *attr* is the
+        name of the output file, *ctry* the ISO3 code of the country, *geom_wkb*
+        the geometry serialized to WKB and *poly_dir* the output directory.
+    """
+    attr,ctry,geom_wkb,poly_dir = args
+
+    # explode the geometry into its subpolygons and extract all exterior-ring
+    # coordinates in a single C call, instead of walking the coordinate
+    # sequence of each polygon through the shapely C API
+    parts = shapely.get_parts(shapely.from_wkb(geom_wkb))
+    ring_coords,ring_index = shapely.get_coordinates(shapely.get_exterior_ring(parts),return_index=True)
+    ring_offsets = numpy.searchsorted(ring_index,numpy.arange(len(parts)+1))
+
+    # the Canada/Russia filters only need a coarse distance gate, so one
+    # vectorized haversine over all part centroids replaces the
+    # per-polygon geodesic calls; the centroids of all parts are computed
+    # in a single call and both coordinates are extracted in one pass
+    keep_part = None
+    if ctry in ('CAN','RUS'):
+        centroids = shapely.get_coordinates(shapely.centroid(parts))
+        cx,cy = centroids[:,0],centroids[:,1]
+        if ctry == 'CAN':
+            keep_part = _haversine(cy,cx,83.24,-79.80) >= 2000
         else:
-            attr=f['GID_0']
-        
-        # start writing the .poly file
-        f = open(poly_dir + "/" + attr +'.poly', 'w')
-        f.write(attr + "\n")
+            keep_part = _haversine(cy,cx,82.26,58.89) >= 500
 
-        i = 0
-        
-        # loop over the different polygons, get their exterior and write the 
-        # coordinates of the ring to the .poly file
-        for polygon in polygons:
-
-            if ctry == 'CAN':
-                dist = geodesic(reversed(polygon.centroid.coords[:1][0]), (83.24,-79.80), ellipsoid='WGS-84').kilometers
-                if dist < 2000:
-                    continue
-
-            if ctry == 'RUS':
-                dist = geodesic(reversed(polygon.centroid.coords[:1][0]), (82.26,58.89), ellipsoid='WGS-84').kilometers
-                if dist < 500:
-                    continue
-                
-            polygon = numpy.array(polygon.exterior)
-
-            j = 0
-            f.write(str(i) + "\n")
-
-            for ring in polygon:
-                j = j + 1
-                f.write("    " + str(ring[0]) + "     " + str(ring[1]) +"\n")
-
-            i = i + 1
-            # close the ring of one subpolygon if done
-            f.write("END" +"\n")
-
-        # close the file when done
-        f.write("END" +"\n")
-        f.close()
-#        except:
-#            print(f['GID_1'])
+    # accumulate the whole .poly file in one pre-encoded buffer, so it goes
+    # out in a single binary write without the text-encoding layer
+    buf = bytearray()
+    buf += (attr + "\n").encode('ascii')
+
+    # bind the hot lookups to locals, so the per-part loop runs on LOAD_FAST
+    # instead of attribute/global lookups
+    extend = buf.extend
+    format_ring = _format_ring
+
+    i = 0
+
+    # loop over the different subpolygons and append the coordinates
+    # of their exterior ring to the buffer
+    for part_num in range(len(parts)):
+
+        if keep_part is not None and not keep_part[part_num]:
+            continue
+
+        ring = ring_coords[ring_offsets[part_num]:ring_offsets[part_num+1]]
+
+        extend((str(i) + "\n").encode('ascii'))
+
+        # format the whole ring in one go instead of one write per coordinate
+        if format_ring is not None:
+            extend(format_ring(ring).tobytes())
+        else:
+            extend((("    %s     %s\n" * len(ring)) % tuple(ring.ravel())).encode('ascii'))
+
+        i = i + 1
+        # close the ring of one subpolygon if done
+        extend(b"END\n")
+
+    # close the polygon when done
+    buf += b"END\n"
+
+    with open(poly_dir + "/" + attr +'.poly', 'wb') as f:
+        f.write(bytes(buf))
 
 def clip_osm_osmconvert(data_path,planet_path,area_poly,area_pbf):
     """ Clip the an area osm file from the larger continent (or planet) file and save to a new osm.pbf file. 
@@ -402,15 +658,17 @@ def clip_osm_osmconvert(data_path,planet_path,area_poly,area_pbf):
 
     osm_convert_path = os.path.join('osmconvert64-0.8.8p')
 
-    try: 
+    try:
         if (os.path.exists(area_pbf) is not True):
-            os.system('{}  {} -B={} --complete-ways -o={}'.format(osm_convert_path,planet_path,area_poly,area_pbf))
+            # pass the arguments as a list, so no shell is forked and paths with spaces just work
+            subprocess.run([osm_convert_path,planet_path,'-B={}'.format(area_poly),'--complete-ways','-o={}'.format(area_pbf)],
+                           check=True,stdout=subprocess.DEVNULL)
         print('{} finished!'.format(area_pbf))
 
-    except:
+    except subprocess.CalledProcessError:
         print('{} did not finish!'.format(area_pbf))
 
-def clip_osm_osmosis(planet_path,area_poly,area_pbf):
+def clip_osm_osmosis(data_path,planet_path,area_poly,area_pbf):
     """ Clip the an area osm file from the larger continent (or planet) file and save to a new osm.pbf file. 
     This is much faster compared to clipping the osm.pbf file while extracting through ogr2ogr.
     
@@ -433,14 +691,76 @@ def clip_osm_osmosis(planet_path,area_poly,area_pbf):
     #osmosis_convert_path = os.path.join("..","osmosis","bin","osmosis.bat")
     osmosis_convert_path = os.path.join("osmosis")
 
-    try: 
+    try:
         if (os.path.exists(area_pbf) is not True):
-            os.system('{} --read-pbf file="{}" --bounding-polygon file="{}" --write-pbf file="{}"'.format(osmosis_convert_path,planet_path,area_poly,area_pbf))
+            # pass the arguments as a list, so no shell is forked and paths with spaces just work
+            subprocess.run([osmosis_convert_path,'--read-pbf','file={}'.format(planet_path),
+                            '--bounding-polygon','file={}'.format(area_poly),
+                            '--write-pbf','file={}'.format(area_pbf)],
+                           check=True,stdout=subprocess.DEVNULL)
         print('{} finished!'.format(area_pbf))
 
-    except:
+    except subprocess.CalledProcessError:
         print('{} did not finish!'.format(area_pbf))
 
+def _init_worker():
+    """
+    Pool initializer that warms the heavyweight imports once per worker,
+    instead of paying for them on the first task of every worker.
+    """
+    import numpy,shapely,subprocess # noqa: F401
+
+def _clip_star(args):
+    """
+    Unpack one (clip_func,data_path,planet_path,area_poly,area_pbf) job, so
+    the clip functions can be fed through Pool.imap_unordered.
+    """
+    clip_func = args[0]
+    clip_func(*args[1:])
+
+def clip_osm_osmium_batch(planet_path,poly_paths,pbf_paths):
+    """ Clip many areas from one larger continent (or planet) file in a single pass.
+
+    This function uses the osmium tool, which can be found at https://osmcode.org/osmium-tool/.
+
+    Where osmconvert and osmosis re-read the full input file for every area,
+    'osmium extract' with a multi-extract config reads the input once and
+    writes all output files in that one pass.
+
+    Arguments:
+        *planet_path*: path string to the osm.pbf file all areas are clipped from.
+
+        *poly_paths*: list of path strings of the .poly files, made through the 'poly_files' function.
+
+        *pbf_paths*: list of path strings of the .osm.pbf output files, one per .poly file.
+
+    Returns:
+        a clipped .osm.pbf file for each .poly file.
+    """
+    extracts = [{'output': os.path.basename(pbf_path),
+                 'output_format': 'pbf',
+                 'polygon': {'file_name': poly_path,'file_type': 'poly'}}
+                for poly_path,pbf_path in zip(poly_paths,pbf_paths)
+                if os.path.exists(pbf_path) is not True]
+
+    if len(extracts) == 0:
+        return
+
+    # osmium keeps every output file open, so cut the batch into chunks that
+    # stay below the open-file limit
+    batch_size = 500
+    for k in range(0,len(extracts),batch_size):
+        config = {'directory': os.path.dirname(pbf_paths[0]),'extracts': extracts[k:k+batch_size]}
+
+        cfg_file = tempfile.NamedTemporaryFile('w',suffix='.json',delete=False)
+        try:
+            json.dump(config,cfg_file)
+            cfg_file.close()
+            subprocess.run(['osmium','extract','-c',cfg_file.name,'-s','complete_ways','--overwrite',planet_path],
+                           check=True,stdout=subprocess.DEVNULL)
+        finally:
+            os.remove(cfg_file.name)
+
 def single_country(country,data_path,regionalized=False,create_poly_files=False,osm_convert=True,geofabrik=False):
     """    
     Obtain a country osm.pbf file. This can be done by extracting it from the planet file or by downloading it from GeoFabrik.
@@ -536,12 +856,15 @@ def single_country(country,data_path,regionalized=False,create_poly_files=False,
         data_paths = [data_path]*len(polyPaths)
         planet_paths = [ctry_pbf]*len(polyPaths)
       
-        # and run all regions parallel to each other
-        pool = Pool(cpu_count()-1)
-        if osm_convert == True:
-            pool.starmap(clip_osm_osmconvert, zip(data_paths,planet_paths,polyPaths,area_pbfs),chunksize=1) 
-        else:
-            pool.starmap(clip_osm_osmosis, zip(data_paths,planet_paths,polyPaths,area_pbfs),chunksize=1) 
+        # and run all regions parallel to each other; the context manager joins
+        # the workers even when a clip fails, and maxtasksperchild recycles
+        # them every 16 tasks so memory stays flat on long runs
+        clip_area = clip_osm_osmconvert if osm_convert == True else clip_osm_osmosis
+        jobs = [(clip_area,)+job for job in zip(data_paths,planet_paths,polyPaths,area_pbfs)]
+
+        with Pool(cpu_count()-1,initializer=_init_worker,maxtasksperchild=16) as pool:
+            for _ in tqdm(pool.imap_unordered(_clip_star,jobs,chunksize=1),total=len(jobs),desc='Clip regions'):
+                pass
 
 
 def all_countries(subset = [], regionalized=False,reversed_order=False,osm_convert=True):
@@ -613,18 +936,43 @@ def all_countries(subset = [], regionalized=False,reversed_order=False,osm_conve
             
     data_paths = [data_path]*len(polyPaths)
 
-    # allow for reversed order if you want to run two at the same time (convenient to work backwards for the second process, to prevent overlapping calculation)   
+    # sort the areas along a Hilbert curve of their centroids, so that areas
+    # that are geographic neighbours are extracted close in time and the
+    # page-cached blocks of the source file get reused
+    world_poly = geopandas.read_file(world_path)
+    attr_col = 'GID_1' if regionalized == True else 'GID_0'
+    centroids = shapely.centroid(world_poly.geometry.values)
+    hilbert_lookup = dict(zip(world_poly[attr_col].values,
+                              _hilbert_index(shapely.get_x(centroids),shapely.get_y(centroids))))
+
+    new_order = numpy.argsort([hilbert_lookup.get(os.path.basename(x)[:-5],-1) for x in polyPaths])
+    polyPaths = [polyPaths[k] for k in new_order]
+    area_pbfs = [area_pbfs[k] for k in new_order]
+    big_osm_paths = [big_osm_paths[k] for k in new_order]
+
+    # allow for reversed order if you want to run two at the same time (convenient to work backwards for the second process, to prevent overlapping calculation)
     if reversed_order == True:
         polyPaths = polyPaths[::-1]
         area_pbfs = area_pbfs[::-1]
         big_osm_paths = big_osm_paths[::-1]
 
-    # extract all country osm files through multiprocesing
-    pool = Pool(cpu_count()-1)
-    if osm_convert==True:
-        pool.starmap(clip_osm_osmconvert, zip(data_paths,big_osm_paths,polyPaths,area_pbfs),chunksize=1) 
+    # extract all country osm files; when osmium is installed each input file
+    # is read only once for all of its outputs, otherwise fall back to
+    # clipping the areas one by one through multiprocesing
+    if shutil.which('osmium') is not None:
+        for big_osm_path in list(dict.fromkeys(big_osm_paths)):
+            group = [k for k in range(len(big_osm_paths)) if big_osm_paths[k] == big_osm_path]
+            clip_osm_osmium_batch(big_osm_path,[polyPaths[k] for k in group],[area_pbfs[k] for k in group])
     else:
-        pool.starmap(clip_osm_osmosis, zip(data_paths,big_osm_paths,polyPaths,area_pbfs),chunksize=1) 
+        # chunksize=4 hands each worker a spatially clustered run of areas;
+        # the context manager joins the workers even when a clip fails, and
+        # maxtasksperchild recycles them every 16 tasks so memory stays flat
+        clip_area = clip_osm_osmconvert if osm_convert == True else clip_osm_osmosis
+        jobs = [(clip_area,)+job for job in zip(data_paths,big_osm_paths,polyPaths,area_pbfs)]
+
+        with Pool(cpu_count()-1,initializer=_init_worker,maxtasksperchild=16) as pool:
+            for _ in tqdm(pool.imap_unordered(_clip_star,jobs,chunksize=4),total=len(jobs),desc='Clip areas'):
+                pass
 
 def country_list():
     """